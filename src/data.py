@@ -3,82 +3,47 @@ import random
 import pickle
 import numpy as np
 import torch
-from scipy.io import loadmat
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-def _fetch(path, name):
-    if name == 'train':
-        token_file = os.path.join(path, 'bow_tr_tokens.mat')
-        count_file = os.path.join(path, 'bow_tr_counts.mat')
-    elif name == 'valid':
-        token_file = os.path.join(path, 'bow_va_tokens.mat')
-        count_file = os.path.join(path, 'bow_va_counts.mat')
-    else:
-        token_file = os.path.join(path, 'bow_ts_tokens.mat')
-        count_file = os.path.join(path, 'bow_ts_counts.mat')
-    tokens = loadmat(token_file)['tokens'].squeeze()
-    counts = loadmat(count_file)['counts'].squeeze()
-    if name == 'test':
-        token_1_file = os.path.join(path, 'bow_ts_h1_tokens.mat')
-        count_1_file = os.path.join(path, 'bow_ts_h1_counts.mat')
-        token_2_file = os.path.join(path, 'bow_ts_h2_tokens.mat')
-        count_2_file = os.path.join(path, 'bow_ts_h2_counts.mat')
-        tokens_1 = loadmat(token_1_file)['tokens'].squeeze()
-        counts_1 = loadmat(count_1_file)['counts'].squeeze()
-        tokens_2 = loadmat(token_2_file)['tokens'].squeeze()
-        counts_2 = loadmat(count_2_file)['counts'].squeeze()
-        return {'tokens': tokens, 'counts': counts, 'tokens_1': tokens_1, 'counts_1': counts_1, 'tokens_2': tokens_2, 'counts_2': counts_2}
-    return {'tokens': tokens, 'counts': counts}
-
-def _fetch_temporal(path, name):
-    if name == 'train':
-        token_file = os.path.join(path, 'bow_tr_tokens.mat')
-        count_file = os.path.join(path, 'bow_tr_counts.mat')
-        time_file = os.path.join(path, 'bow_tr_timestamps.mat')
-    elif name == 'valid':
-        token_file = os.path.join(path, 'bow_va_tokens.mat')
-        count_file = os.path.join(path, 'bow_va_counts.mat')
-        time_file = os.path.join(path, 'bow_va_timestamps.mat')
-    else:
-        token_file = os.path.join(path, 'bow_ts_tokens.mat')
-        count_file = os.path.join(path, 'bow_ts_counts.mat')
-        time_file = os.path.join(path, 'bow_ts_timestamps.mat')
-    tokens = loadmat(token_file)['tokens'].squeeze()
-    counts = loadmat(count_file)['counts'].squeeze()
-    times = loadmat(time_file)['timestamps'].squeeze()
+def _split_rows(values, indptr):
+    # Rows of a CSR component as (1, L) arrays, the layout of the documents in the former .mat files
+    rows = np.empty(len(indptr) - 1, dtype=object)
+    for i, (start, end) in enumerate(zip(indptr[:-1], indptr[1:])):
+        rows[i] = values[np.newaxis, start:end]
+    return rows
+
+def _load_bow(path, split):
+    with np.load(os.path.join(path, 'bow_{}.npz'.format(split))) as f:
+        indptr = f['indptr']
+        tokens, counts = _split_rows(f['indices'], indptr), _split_rows(f['data'], indptr)
+        times = f['timestamps'] if 'timestamps' in f.files else None
+    return tokens, counts, times
+
+def _fetch(path, name, temporal=False):
+    split = {'train': 'tr', 'valid': 'va'}.get(name, 'ts')
+    tokens, counts, times = _load_bow(path, split)
+    fetched = {'tokens': tokens, 'counts': counts}
+    if temporal:
+        fetched['times'] = times
     if name == 'test':
-        token_1_file = os.path.join(path, 'bow_ts_h1_tokens.mat')
-        count_1_file = os.path.join(path, 'bow_ts_h1_counts.mat')
-        token_2_file = os.path.join(path, 'bow_ts_h2_tokens.mat')
-        count_2_file = os.path.join(path, 'bow_ts_h2_counts.mat')
-        tokens_1 = loadmat(token_1_file)['tokens'].squeeze()
-        counts_1 = loadmat(count_1_file)['counts'].squeeze()
-        tokens_2 = loadmat(token_2_file)['tokens'].squeeze()
-        counts_2 = loadmat(count_2_file)['counts'].squeeze()
-        return {'tokens': tokens, 'counts': counts, 'times': times,
-                    'tokens_1': tokens_1, 'counts_1': counts_1,
-                        'tokens_2': tokens_2, 'counts_2': counts_2}
-    return {'tokens': tokens, 'counts': counts, 'times': times}
+        fetched['tokens_1'], fetched['counts_1'], _ = _load_bow(path, 'ts_h1')
+        fetched['tokens_2'], fetched['counts_2'], _ = _load_bow(path, 'ts_h2')
+    return fetched
 
 def get_data(path, temporal=False):
     ### load vocabulary
     with open(os.path.join(path, 'vocab.pkl'), 'rb') as f:
         vocab = pickle.load(f)
 
-    if not temporal:
-        train = _fetch(path, 'train')
-        valid = _fetch(path, 'valid')
-        test = _fetch(path, 'test')
-    else:
-        train = _fetch_temporal(path, 'train')
-        valid = _fetch_temporal(path, 'valid')
-        test = _fetch_temporal(path, 'test')
+    train = _fetch(path, 'train', temporal)
+    valid = _fetch(path, 'valid', temporal)
+    test = _fetch(path, 'test', temporal)
 
     return vocab, train, valid, test
 
-def get_batch(tokens, counts, ind, vocab_size, emsize=300, temporal=False, times=None):
-    """fetch input data by batch."""
+def _fill_batch(tokens, counts, ind, vocab_size, temporal=False, times=None):
+    """build the dense numpy arrays of a batch."""
     batch_size = len(ind)
     data_batch = np.zeros((batch_size, vocab_size))
 
@@ -101,12 +66,55 @@ def get_batch(tokens, counts, ind, vocab_size, emsize=300, temporal=False, times
         if doc_id != -1:
             for j, word in enumerate(doc):
                 data_batch[i, word] = count[j]
+    if temporal:
+        return data_batch, times_batch
+    return data_batch
+
+def get_batch(tokens, counts, ind, vocab_size, emsize=300, temporal=False, times=None):
+    """fetch input data by batch."""
+    if temporal:
+        data_batch, times_batch = _fill_batch(tokens, counts, ind, vocab_size, temporal, times)
+    else:
+        data_batch = _fill_batch(tokens, counts, ind, vocab_size)
     data_batch = torch.from_numpy(data_batch).float().to(device)
     if temporal:
         times_batch = torch.from_numpy(times_batch).to(device)
         return data_batch, times_batch
     return data_batch
 
+def prefetch_batches(tokens, counts, batches, vocab_size):
+    """fetch input data by batch, building each batch while the previous one is in use.
+
+    On GPU the batches are filled in pinned memory and copied on a separate stream, so that
+    building and copying the next batch overlap with the computations on the current one."""
+    if device.type != 'cuda':
+        for ind in batches:
+            yield get_batch(tokens, counts, ind, vocab_size)
+        return
+    copy_stream = torch.cuda.Stream()
+
+    def load(ind):
+        data_batch = torch.from_numpy(_fill_batch(tokens, counts, ind, vocab_size)).float().pin_memory()
+        with torch.cuda.stream(copy_stream):
+            data_batch = data_batch.to(device, non_blocking=True)
+            copied = torch.cuda.Event()
+            copied.record()
+        return data_batch, copied
+
+    def ready(data_batch, copied):
+        torch.cuda.current_stream().wait_event(copied)
+        data_batch.record_stream(torch.cuda.current_stream())
+        return data_batch
+
+    pending = None
+    for ind in batches:
+        loaded = load(ind)
+        if pending is not None:
+            yield ready(*pending)
+        pending = loaded
+    if pending is not None:
+        yield ready(*pending)
+
 def get_rnn_input(tokens, counts, times, num_times, vocab_size, num_docs):
     indices = torch.randperm(num_docs)
     indices = torch.split(indices, 1000)
@@ -4,7 +4,7 @@ import numpy as np
 import math
 from .data import get_batch
 from pathlib import Path
-from .utils import nearest_neighbors, get_topic_coherence, get_topic_diversity
+from .utils import nearest_neighbors, get_top_words, get_topic_coherence, get_topic_diversity
 
 from torch import nn, optim
 
@@ -198,7 +198,7 @@ class ETM(nn.Module):
                 normalized_data_batch = data_batch / sums
             else:
                 normalized_data_batch = data_batch
-            recon_loss, kld_theta = self.forward(data_batch, normalized_data_batch)
+            recon_loss, kld_theta = self(data_batch, normalized_data_batch)
             total_loss = recon_loss + kld_theta
             total_loss.backward()
             if clip > 0:
@@ -238,10 +238,8 @@ class ETM(nn.Module):
             print('#'*100)
             print('Visualize topics...')
             topics_words = []
-            gammas = self.get_beta()
-            for k in range(self.num_topics):
-                gamma = gammas[k]
-                top_words = list(gamma.cpu().numpy().argsort()[-num_words+1:][::-1])
+            gammas = self.get_beta().cpu().numpy()
+            for top_words in get_top_words(gammas, num_words - 1):
                 topic_words = [vocabulary[a].strip() for a in top_words]
                 topics_words.append(' '.join(topic_words))
 
@@ -1,5 +1,6 @@
 #import gensim
 import csv
+import hashlib
 import json
 import numpy as np
 import os
@@ -124,30 +125,45 @@ def save_embeddings(emb_model, emb_file, vocab=[]):
     print('saved embeddings for ' + str(c_a) + '/' + str(len(vocab)) + ' words!')
 
 
-def load_embeddings(emb_file, emb_size, vocab):
+def load_embeddings(emb_file, emb_size, vocab, cache=False):
     """
     emb_file : file created with 'save_embeddings' (.txt)
     emb_size : dimension of word embeddings
     vocab    : list of string specifying the words to load
+    cache    : if True, the embeddings found in emb_file are saved in emb_file + '.npz' and reused by the next calls
+               (the cache is ignored if it is older than emb_file or it was built for another vocab/emb_size)
+    Words which are not in emb_file are sampled at every call, so they follow the seed of np.random.
     """
-    print('loading word embeddings:')
-    vectors = {}
-    with open(emb_file, 'rb') as f:
-        for l in f:
-            line = l.decode('latin-1').split()
-            word = line[0]
-            if word in vocab:
-                vect = np.array(line[1:]).astype(np.float)
-                vectors[word] = vect
-    embeddings = np.zeros((len(vocab), emb_size))
-    words_found, words_sampled = 0, 0
-    for i, word in enumerate(vocab):
-        try:
-            embeddings[i] = vectors[word]
-            words_found += 1
-        except KeyError:
-            embeddings[i] = np.random.normal(scale=0.6, size=(emb_size, ))
-            words_sampled += 1
+    cache_file = emb_file + '.npz'
+    vocab_hash = hashlib.sha1('\n'.join(vocab).encode('utf-8')).hexdigest()
+    embeddings = None
+    if cache and os.path.isfile(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(emb_file):
+        with np.load(cache_file) as f:
+            if str(f['vocab_hash']) == vocab_hash and f['embeddings'].shape == (len(vocab), emb_size):
+                print('loading word embeddings from ' + cache_file)
+                embeddings, found = f['embeddings'], f['found']
+    if embeddings is None:
+        print('loading word embeddings:')
+        vectors = {}
+        with open(emb_file, 'rb') as f:
+            for l in f:
+                line = l.decode('latin-1').split()
+                word = line[0]
+                if word in vocab:
+                    vect = np.array(line[1:]).astype(np.float)
+                    vectors[word] = vect
+        embeddings = np.zeros((len(vocab), emb_size))
+        found = np.zeros(len(vocab), dtype=bool)
+        for i, word in enumerate(vocab):
+            if word in vectors:
+                embeddings[i] = vectors[word]
+                found[i] = True
+        if cache:
+            np.savez(cache_file, vocab_hash=vocab_hash, embeddings=embeddings, found=found)
+    for i in np.flatnonzero(~found):
+        embeddings[i] = np.random.normal(scale=0.6, size=(emb_size, ))
+    words_found = int(found.sum())
+    words_sampled = len(vocab) - words_found
     print('words_found   ', words_found, '/',  words_found+words_sampled, sep='')
     print('words_sampled ', words_sampled, '/',  words_found+words_sampled, sep='')
     return embeddings
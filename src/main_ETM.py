@@ -3,26 +3,18 @@
 from __future__ import print_function
 
 import torch
-import pickle
 import numpy as np
 import os
-import math
-import random
 import sys
-import matplotlib.pyplot as plt
-import scipy.io
 
 import src.data as data
 
-from torch import nn, optim, save as torch_save
-from torch.nn import functional as F
+from torch import save as torch_save
 from pathlib import Path
-from gensim.models.fasttext import FastText as FT_gensim
-import tracemalloc
 
 from src.etm import ETM
 from src.file_io import load_embeddings
-from src.utils import nearest_neighbors, get_topic_coherence, get_topic_diversity
+from src.utils import nearest_neighbors, get_top_words, get_topic_coherence, get_topic_diversity
 
 
 def main_ETM(dataset, data_path, emb_file, save_path, model_file, batch_size=1000,
@@ -74,6 +66,12 @@ def main_ETM(dataset, data_path, emb_file, save_path, model_file, batch_size=100
     torch.manual_seed(seed)
     if torch.cuda.is_available():
         torch.cuda.manual_seed(seed)
+        ## batches have fixed shapes: let cuDNN pick the fastest algorithms, and run fp32 matmuls on tensor cores (TF32)
+        torch.backends.cudnn.benchmark = True
+        if hasattr(torch, 'set_float32_matmul_precision'):
+            torch.set_float32_matmul_precision('high')
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
 
     print('=*'*100)
     print('Training an Embedded Topic Model on ' + dataset.upper())
@@ -83,6 +81,7 @@ def main_ETM(dataset, data_path, emb_file, save_path, model_file, batch_size=100
     # 1. vocabulary
     vocab, train, valid, test = data.get_data(os.path.join(data_path))
     vocab_size = len(vocab)
+    vocab_arr = np.asarray(vocab, dtype=object)  # to map arrays of word ids to words at once
 
     # 1. training data
     train_tokens = train['tokens']
@@ -107,8 +106,11 @@ def main_ETM(dataset, data_path, emb_file, save_path, model_file, batch_size=100
 
     embeddings = None
     if not train_embeddings:
-        embeddings = load_embeddings(emb_file, emb_size, vocab)
-        embeddings = torch.from_numpy(embeddings).to(device)
+        embeddings = load_embeddings(emb_file, emb_size, vocab, cache=True)
+        embeddings = torch.from_numpy(embeddings)
+        if device.type == 'cuda':
+            embeddings = embeddings.pin_memory()
+        embeddings = embeddings.to(device, non_blocking=True)
         embeddings_dim = embeddings.size()
 
     ## define checkpoint
@@ -125,23 +127,36 @@ def main_ETM(dataset, data_path, emb_file, save_path, model_file, batch_size=100
 
     print('ETM architecture: {}'.format(model))
 
+    ## compile the forward pass (torch>=2.2): CUDA graphs remove the per-batch launch overhead; set PMDA_COMPILE=0 to disable
+    if device.type == 'cuda' and hasattr(model, 'compile') and os.environ.get('PMDA_COMPILE', '1') != '0':
+        model.compile(mode='reduce-overhead')
+
     optimizer = model.get_optimizer(optimizer, lr, wdecay)
 
-    tracemalloc.start()
+    ## track peak memory without tracing every Python allocation
+    if device.type == 'cuda':
+        if hasattr(torch.cuda, 'reset_peak_memory_stats'):
+            torch.cuda.reset_peak_memory_stats()
+        else:
+            torch.cuda.reset_max_memory_allocated()  # torch<1.4
     if mode == 'train':
-        ## train model on data
+        ## train model on data, in bf16 autocast on GPUs supporting it (the optimizer state and the evaluation stay in fp32)
+        use_bf16 = device.type == 'cuda' and hasattr(torch, 'autocast') and torch.cuda.is_bf16_supported()
         best_epoch = 0
         best_val_ppl = 1e9
         all_val_ppls = []
         for epoch in range(0, epochs):
             print("I am training for epoch", epoch)
-            model.train_for_epoch(epoch, num_docs_train, batch_size, train_tokens, train_counts, vocab_size, bow_norm, clip, log_interval)
+            if use_bf16:
+                with torch.autocast('cuda', dtype=torch.bfloat16):
+                    model.train_for_epoch(epoch, num_docs_train, batch_size, train_tokens, train_counts, vocab_size, bow_norm, clip, log_interval)
+            else:
+                model.train_for_epoch(epoch, num_docs_train, batch_size, train_tokens, train_counts, vocab_size, bow_norm, clip, log_interval)
             val_ppl = model.evaluate(eval_batch_size, num_docs_valid, num_docs_test, num_docs_test_1, test_1_tokens, test_1_counts,
                                      test_2_tokens, test_2_counts, vocab, bow_norm, train_tokens, 'val', tc, td)
             print("The validation scores", val_ppl)
             if val_ppl < best_val_ppl:
-                with open(ckpt, 'wb') as f:
-                    torch.save(model, f)
+                torch.save(model.state_dict(), ckpt)
                 best_epoch = epoch
                 best_val_ppl = val_ppl
             else:
@@ -152,44 +167,72 @@ def main_ETM(dataset, data_path, emb_file, save_path, model_file, batch_size=100
             if epoch > 0 and epoch % visualize_every == 0:
                 model.visualize(batch_size, epochs, num_words, vocab, True)
             all_val_ppls.append(val_ppl)
-        with open(ckpt, 'rb') as f:
-            model = torch.load(f)
-        model = model.to(device)
+        ## the checkpoint holds only the weights: load them into the model defined above
+        model.load_state_dict(torch.load(ckpt, map_location=device))
         val_ppl = model.evaluate(eval_batch_size, num_docs_valid, num_docs_test, num_docs_test_1, test_1_tokens, test_1_counts,
                                  test_2_tokens, test_2_counts, vocab, bow_norm, train_tokens, 'val', tc, td)
     else:
-        with open(ckpt, 'rb') as f:
-            model = torch.load(f)
-        model = model.to(device)
+        model.load_state_dict(torch.load(ckpt, map_location=device))
         model.eval()
 
-        with torch.no_grad():
+        ## inference mode (torch>=1.9) skips the autograd bookkeeping that no_grad still does
+        with (torch.inference_mode() if hasattr(torch, 'inference_mode') else torch.no_grad()):
             ## get document completion perplexities
             test_ppl = model.evaluate(eval_batch_size, num_docs_valid, num_docs_test, num_docs_test_1, test_1_tokens, test_1_counts,
                                       test_2_tokens, test_2_counts, vocab, bow_norm, train_tokens, 'val', False, False)
             ## get most used topics
-            indices = torch.tensor(range(num_docs_train))
-            indices = torch.split(indices, batch_size)
-            theta_tr = np.array([], dtype=np.int64).reshape(0,num_topics)
+            indices = torch.split(torch.arange(num_docs_train), batch_size)
+            theta_tr = np.empty((num_docs_train, num_topics), dtype=np.float32)
+            offset = 0
+            ## on GPU, theta is copied to two pinned buffers in turn (non_blocking) on a side stream, so that
+            ## the copy of a batch overlaps with the next forward pass; pending holds (offset, size) of each buffer
+            if device.type == 'cuda':
+                copy_stream = torch.cuda.Stream()
+                pinned = [torch.empty(batch_size, num_topics, pin_memory=True) for _ in range(2)]
+                copied = [torch.cuda.Event(), torch.cuda.Event()]
+                pending = [None, None]
+
+            def flush(buf):
+                if pending[buf] is not None:
+                    start, size = pending[buf]
+                    copied[buf].synchronize()
+                    theta_tr[start:start+size] = pinned[buf][:size].numpy()
+                    pending[buf] = None
+
             thetaAvg = torch.zeros(1, num_topics).to(device)
             theta_weighted_average = torch.zeros(1, num_topics).to(device)
-            cnt = 0
-            for idx, indice in enumerate(indices):
-                data_batch = data.get_batch(train_tokens, train_counts, indice, vocab_size, device)
+            cnt = torch.zeros(1).to(device)
+            batches = data.prefetch_batches(train_tokens, train_counts, indices, vocab_size)
+            for idx, (indice, data_batch) in enumerate(zip(indices, batches)):
                 sums = data_batch.sum(1).unsqueeze(1)
-                cnt += sums.sum(0).squeeze().cpu().numpy()
+                cnt += sums.sum(0)
                 if bow_norm:
                     normalized_data_batch = data_batch / sums
                 else:
                     normalized_data_batch = data_batch
                 theta, _ = model.get_theta(normalized_data_batch)
-                theta_tr = np.vstack([theta_tr, theta.cpu().numpy()])
+                if device.type == 'cuda':
+                    buf = idx % 2
+                    flush(buf)
+                    copy_stream.wait_stream(torch.cuda.current_stream())
+                    with torch.cuda.stream(copy_stream):
+                        pinned[buf][:len(indice)].copy_(theta, non_blocking=True)
+                        copied[buf].record()
+                    theta.record_stream(copy_stream)
+                    pending[buf] = (offset, len(indice))
+                else:
+                    theta_tr[offset:offset+len(indice)] = theta.numpy()
+                offset += len(indice)
                 thetaAvg += theta.sum(0).unsqueeze(0) / num_docs_train
                 weighed_theta = sums * theta
                 theta_weighted_average += weighed_theta.sum(0).unsqueeze(0)
                 if idx % 100 == 0 and idx > 0:
                     print('batch: {}/{}'.format(idx, len(indices)))
-            theta_weighted_average = theta_weighted_average.squeeze().cpu().numpy() / cnt
+            if device.type == 'cuda':
+                flush(0)
+                flush(1)
+            ## accumulators stay on device during the loop: one transfer at the end
+            theta_weighted_average = (theta_weighted_average.squeeze() / cnt).cpu().numpy()
             #print('\nThe 10 most used topics are {}'.format(theta_weighted_average.argsort()[::-1]))
             #print('The weighs are {}'.format(sorted(theta_weighted_average, reverse=True)))
             print('Most used topics:')
@@ -197,16 +240,13 @@ def main_ETM(dataset, data_path, emb_file, save_path, model_file, batch_size=100
                 print("Topic "+str(ttt).rjust(3)+" :  ", theta_weighted_average[ttt])
 
             ## show topics
-            beta = model.get_beta()
+            beta = model.get_beta().data.cpu().numpy()
             print('\nTop', num_words, 'words per topic:')
-            for k in range(num_topics):
-                gamma = beta[k]
-                top_words = list(gamma.cpu().numpy().argsort()[-num_words+1:][::-1])
-                topic_words = [vocab[a] for a in top_words]
+            for k, top_words in enumerate(get_top_words(beta, num_words - 1)):
+                topic_words = vocab_arr[top_words].tolist()
                 print('Topic {}: {}'.format(k, topic_words))
 
             # compute topic coherence and topic diversity
-            beta = beta.data.cpu().numpy()
             if tc:
                 TC, _ = get_topic_coherence(beta, train_tokens, vocab)
             else:
@@ -236,6 +276,13 @@ def main_ETM(dataset, data_path, emb_file, save_path, model_file, batch_size=100
                     print('word: {} .. etm neighbors: {}'.format(word, nearest_neighbors(word, rho_etm, vocab, 20)))
                 print('\n')
 
-    current, peak = tracemalloc.get_traced_memory()
-    print(f"Current memory usage is {current / 10**6}MB; Peak was {peak / 10**6}MB")
-    tracemalloc.stop()
+    if device.type == 'cuda':
+        print(f"Peak GPU memory allocated was {torch.cuda.max_memory_allocated() / 10**6}MB")
+    try:
+        import resource
+    except ImportError:  # not available on Windows
+        resource = None
+    if resource is not None:
+        ## ru_maxrss is the peak of the whole process (bytes on macOS, KiB elsewhere), not of this call only
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(f"Peak resident memory of the process was {maxrss / (2**20 if sys.platform == 'darwin' else 2**10)}MB")
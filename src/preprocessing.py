@@ -8,7 +8,6 @@ import random
 import string
 
 from scipy import sparse
-from scipy.io import savemat, loadmat
 from sklearn.feature_extraction.text import CountVectorizer
 
 def preprocessing(data_path, docs, timestamps=[], stopwords=[], min_df=1, max_df=0.7, data_split=[0.85,0.1,0.05], seed=28):
@@ -47,22 +46,19 @@ def preprocessing(data_path, docs, timestamps=[], stopwords=[], min_df=1, max_df
 
     # Get vocabulary
     print('building the vocabulary...')
-    sum_counts = cvz.sum(axis=0)  # (1, V) numpy matrix
-    v_size = sum_counts.shape[1]  # V = v_size
-    sum_counts_np = np.zeros(v_size, dtype=int)
-    for v in range(v_size):
-        sum_counts_np[v] = sum_counts[0,v]
+    sum_counts_np = np.asarray(cvz.sum(axis=0)).ravel().astype(np.int64, copy=False)  # (V,) numpy array
+    v_size = sum_counts_np.shape[0]  # V = v_size
     word2id = dict([(w, cvectorizer.vocabulary_.get(w)) for w in cvectorizer.vocabulary_])  # dict with V elements
     id2word = dict([(cvectorizer.vocabulary_.get(w), w) for w in cvectorizer.vocabulary_])  # dict with V elements
     del cvectorizer
     print('  initial vocabulary size: V={}'.format(v_size))
 
-    # Sort elements in vocabulary
+    # Sort elements in vocabulary and filter out stopwords (if any)
     idx_sort = np.argsort(sum_counts_np)
-    vocab_aux = [id2word[idx_sort[cc]] for cc in range(v_size)]
-
-    # Filter out stopwords (if any)
-    vocab_aux = [w for w in vocab_aux if w not in stopwords]
+    stopwords_set = frozenset(stopwords)
+    initial_words = np.array([id2word[i] for i in range(v_size)], dtype=object)
+    vocab_aux = [w for w in initial_words[idx_sort] if w not in stopwords_set]
+    del initial_words
     print('  vocabulary size after removing stopwords from list: V={}'.format(len(vocab_aux)))
 
     # Create dictionary and inverse dictionary
@@ -86,70 +82,101 @@ def preprocessing(data_path, docs, timestamps=[], stopwords=[], min_df=1, max_df
     del cvz
     idx_permute = np.random.permutation(num_docs).astype(int)
 
+    # Raw texts of the documents, i.e., docs_tr/docs_ts/docs_va are lists of strings
+    docs_tr = [docs[idx_d] for idx_d in idx_permute[:trSize]]
+    docs_ts = [docs[idx_d] for idx_d in idx_permute[trSize:trSize+tsSize]]
+    docs_va = [docs[idx_d] for idx_d in idx_permute[trSize+tsSize:]]
+
+    def remove_words(in_tokens, in_lengths):
+        # Remove words with id -1 (i.e. not in vocabulary) and update the length of the documents
+        keep = in_tokens >= 0
+        out_lengths = np.bincount(np.repeat(np.arange(len(in_lengths)), in_lengths)[keep], minlength=len(in_lengths))
+        return in_tokens[keep], out_lengths
+
+    def tokenize(in_docs):
+        # Split the documents and map each word to its id (-1 if not in vocabulary): map() and np.fromiter()
+        # run the loop over the words in C, without building lists of lists of id
+        splitted_docs = [doc.split() for doc in in_docs]
+        lengths = np.fromiter(map(len, splitted_docs), dtype=np.int64, count=len(splitted_docs))
+        tokens = np.fromiter(map(word2id.get, itertools.chain.from_iterable(splitted_docs), itertools.repeat(-1)),
+                             dtype=np.int64, count=int(lengths.sum()))
+        return remove_words(tokens, lengths)
+
+    # Bag-of-Words (BoW) representation of the documents, i.e., tokens_tr/tokens_ts/tokens_va are arrays with the ids
+    # of the words of all documents (in order) and lengths_tr/lengths_ts/lengths_va are arrays with the document lengths
+    tokens_tr, lengths_tr = tokenize(docs_tr)
+    tokens_ts, lengths_ts = tokenize(docs_ts)
+    tokens_va, lengths_va = tokenize(docs_va)
+
     # Remove words not in train corpus
-    vocab = list(set([w for idx_d in range(trSize) for w in docs[idx_permute[idx_d]].split() if w in word2id]))
+    # (the documents are already tokenized: re-map the ids of the words observed in train and assign -1 to the others)
+    ids_tr = np.unique(tokens_tr)
+    new_ids = np.full(len(vocab), -1, dtype=np.int64)
+    new_ids[ids_tr] = np.arange(len(ids_tr))
+    tokens_tr = new_ids[tokens_tr]
+    tokens_ts, lengths_ts = remove_words(new_ids[tokens_ts], lengths_ts)
+    tokens_va, lengths_va = remove_words(new_ids[tokens_va], lengths_va)
+    vocab = [vocab[j] for j in ids_tr]
     word2id = dict([(w, j) for j, w in enumerate(vocab)])
-    id2word = dict([(j, w) for j, w in enumerate(vocab)])
+    id2word_arr = np.asarray(vocab, dtype=object)
+    del ids_tr
+    del new_ids
     print('  vocabulary after removing words not in train: {}'.format(len(vocab)))
 
-    # Bag-of-Words (BoW) representation of the documents, i.e., docs_tr/docs_ts/docs_va are lists of lists of id
-    docs_tr = [[word2id[w] for w in docs[idx_permute[idx_d]].split() if w in word2id] for idx_d in range(trSize)]
-    docs_ts = [[word2id[w] for w in docs[idx_permute[idx_d+trSize]].split() if w in word2id] for idx_d in range(tsSize)]
-    docs_va = [[word2id[w] for w in docs[idx_permute[idx_d+trSize+tsSize]].split() if w in word2id] for idx_d in range(vaSize)]
+    # timestamps of the documents, i.e., timestamps_tr/timestamps_ts/timestamps_va are arrays of id
+    timestamps_tr = np.array([time2id[timestamps[idx_d]] for idx_d in idx_permute[:trSize]], dtype=int)
+    timestamps_ts = np.array([time2id[timestamps[idx_d]] for idx_d in idx_permute[trSize:trSize+tsSize]], dtype=int)
+    timestamps_va = np.array([time2id[timestamps[idx_d]] for idx_d in idx_permute[trSize+tsSize:]], dtype=int)
 
-    # timestamps of the documents, i.e., timestamps_tr/timestamps_ts/timestamps_va are lists of id
-    timestamps_tr = [time2id[timestamps[idx_permute[idx_d]]] for idx_d in range(trSize)]
-    timestamps_ts = [time2id[timestamps[idx_permute[idx_d+trSize]]] for idx_d in range(tsSize)]
-    timestamps_va = [time2id[timestamps[idx_permute[idx_d+trSize+tsSize]]] for idx_d in range(vaSize)]
-
-    # indices of the documents, i.e., indices_tr/indices_ts/indices_va are lists of integers
-    indices_tr = [int(idx_permute[idx_d]) for idx_d in range(trSize)]
-    indices_ts = [int(idx_permute[idx_d+trSize]) for idx_d in range(tsSize)]
-    indices_va = [int(idx_permute[idx_d+trSize+tsSize]) for idx_d in range(vaSize)]
+    # indices of the documents, i.e., indices_tr/indices_ts/indices_va are arrays of integers
+    indices_tr = idx_permute[:trSize]
+    indices_ts = idx_permute[trSize:trSize+tsSize]
+    indices_va = idx_permute[trSize+tsSize:]
 
     # Remove unused variables
     del docs
+    del docs_tr
+    del docs_ts
+    del docs_va
 
-    print('  number of documents (train): {} [this should be equal to {} and {}]'.format(len(docs_tr), trSize, len(timestamps_tr)))
-    print('  number of documents (test): {} [this should be equal to {} and {}]'.format(len(docs_ts), tsSize, len(timestamps_ts)))
-    print('  number of documents (valid): {} [this should be equal to {} and {}]'.format(len(docs_va), vaSize, len(timestamps_va)))
+    print('  number of documents (train): {} [this should be equal to {} and {}]'.format(len(lengths_tr), trSize, len(timestamps_tr)))
+    print('  number of documents (test): {} [this should be equal to {} and {}]'.format(len(lengths_ts), tsSize, len(timestamps_ts)))
+    print('  number of documents (valid): {} [this should be equal to {} and {}]'.format(len(lengths_va), vaSize, len(timestamps_va)))
 
     # Remove empty documents
     print('removing empty documents...')
 
-    def remove_empty(in_docs, in_timestamps, in_indices):
-        out_docs = []
-        out_timestamps = []
-        out_indices = []
-        for ii, doc in enumerate(in_docs):
-            if(doc!=[]):
-                out_docs.append(doc)
-                out_timestamps.append(in_timestamps[ii])
-                out_indices.append(in_indices[ii])
-        return out_docs, out_timestamps, out_indices
-
-    def remove_by_threshold(in_docs, in_timestamps, in_indices, thr):
-        out_docs = []
-        out_timestamps = []
-        out_indices = []
-        for ii, doc in enumerate(in_docs):
-            if(len(doc)>thr):
-                out_docs.append(doc)
-                out_timestamps.append(in_timestamps[ii])
-                out_indices.append(in_indices[ii])
-        return out_docs, out_timestamps, out_indices
+    def remove_by_threshold(in_tokens, in_lengths, in_timestamps, in_indices, thr):
+        keep = in_lengths > thr
+        out_tokens = in_tokens[np.repeat(keep, in_lengths)]
+        return out_tokens, in_lengths[keep], in_timestamps[keep], in_indices[keep]
 
     # Remove empty documents, i.e. they contain only words not in the vocabulary of train corpus
-    docs_tr, timestamps_tr, indices_tr = remove_empty(docs_tr, timestamps_tr, indices_tr)
-    docs_ts, timestamps_ts, indices_ts = remove_empty(docs_ts, timestamps_ts, indices_ts)
-    docs_va, timestamps_va, indices_va = remove_empty(docs_va, timestamps_va, indices_va)
+    tokens_tr, lengths_tr, timestamps_tr, indices_tr = remove_by_threshold(tokens_tr, lengths_tr, timestamps_tr, indices_tr, 0)
+    tokens_ts, lengths_ts, timestamps_ts, indices_ts = remove_by_threshold(tokens_ts, lengths_ts, timestamps_ts, indices_ts, 0)
+    tokens_va, lengths_va, timestamps_va, indices_va = remove_by_threshold(tokens_va, lengths_va, timestamps_va, indices_va, 0)
     # Remove test documents with length=1 (or less)
-    docs_ts, timestamps_ts, indices_ts = remove_by_threshold(docs_ts, timestamps_ts, indices_ts, 1)
+    tokens_ts, lengths_ts, timestamps_ts, indices_ts = remove_by_threshold(tokens_ts, lengths_ts, timestamps_ts, indices_ts, 1)
+
+    # List of lists of id, i.e., the tokens of each document in train
+    ends_tr = np.cumsum(lengths_tr)
+    docs_tr = [tokens_tr[start:end].tolist() for start, end in zip(ends_tr - lengths_tr, ends_tr)]
+    del ends_tr
+    indices_tr = indices_tr.tolist()
+    indices_ts = indices_ts.tolist()
+    indices_va = indices_va.tolist()
 
     # Split documents in test set in 2 halves
     print('splitting test documents in 2 halves...')
-    docs_ts_h1 = [[w for i,w in enumerate(doc) if i<=len(doc)/2.0-1] for doc in docs_ts]
-    docs_ts_h2 = [[w for i,w in enumerate(doc) if i>len(doc)/2.0-1] for doc in docs_ts]
+    # (the first half takes the first lengths_ts//2 tokens of each document, the second half the others)
+    lengths_ts_h1 = lengths_ts // 2
+    lengths_ts_h2 = lengths_ts - lengths_ts_h1
+    positions_ts = np.arange(len(tokens_ts)) - np.repeat(np.cumsum(lengths_ts) - lengths_ts, lengths_ts)
+    in_h1 = positions_ts < np.repeat(lengths_ts_h1, lengths_ts)
+    tokens_ts_h1 = tokens_ts[in_h1]
+    tokens_ts_h2 = tokens_ts[~in_h1]
+    del positions_ts
+    del in_h1
 
     # ----------------------------------------------------------------
     # DOCUMENT PRE-PROCESSING ENDS HERE: NOW WE JUST HAVE TO SAVE THEM
@@ -162,84 +189,56 @@ def preprocessing(data_path, docs, timestamps=[], stopwords=[], min_df=1, max_df
                  "indices_va": indices_va,
                  "docs_tr": docs_tr,
                  "vocab_tr": vocab}
+    # json.dump streams the encoded chunks to the file instead of building the whole string first:
+    # it is slower than json.dumps (it never uses the C encoder), but saves the memory of the string
     with open(path_save + 'info.json', 'w') as f:
-        f.write(json.dumps(info_json, indent = 2))
-
-    # Getting lists of words and doc_indices
-    print('creating lists of words...')
-
-    def create_list_words(in_docs):
-        return [x for y in in_docs for x in y]
-
-    words_tr = create_list_words(docs_tr)
-    words_ts = create_list_words(docs_ts)
-    words_ts_h1 = create_list_words(docs_ts_h1)
-    words_ts_h2 = create_list_words(docs_ts_h2)
-    words_va = create_list_words(docs_va)
-
-    print('  len(words_tr):\t', len(words_tr))
-    print('  len(words_ts):\t', len(words_ts))
-    print('  len(words_ts_h1):\t', len(words_ts_h1))
-    print('  len(words_ts_h2):\t', len(words_ts_h2))
-    print('  len(words_va):\t', len(words_va))
-
-    # Get doc indices
-    print('getting doc indices...')
-
-    def create_doc_indices(in_docs):
-        aux = [[j for i in range(len(doc))] for j, doc in enumerate(in_docs)]
-        return [int(x) for y in aux for x in y]
-
-    doc_indices_tr = create_doc_indices(docs_tr)
-    doc_indices_ts = create_doc_indices(docs_ts)
-    doc_indices_ts_h1 = create_doc_indices(docs_ts_h1)
-    doc_indices_ts_h2 = create_doc_indices(docs_ts_h2)
-    doc_indices_va = create_doc_indices(docs_va)
-
-    print('  len(np.unique(doc_indices_tr)): {} [this should be {}]'.format(len(np.unique(doc_indices_tr)), len(docs_tr)))
-    print('  len(np.unique(doc_indices_ts)): {} [this should be {}]'.format(len(np.unique(doc_indices_ts)), len(docs_ts)))
-    print('  len(np.unique(doc_indices_ts_h1)): {} [this should be {}]'.format(len(np.unique(doc_indices_ts_h1)), len(docs_ts_h1)))
-    print('  len(np.unique(doc_indices_ts_h2)): {} [this should be {}]'.format(len(np.unique(doc_indices_ts_h2)), len(docs_ts_h2)))
-    print('  len(np.unique(doc_indices_va)): {} [this should be {}]'.format(len(np.unique(doc_indices_va)), len(docs_va)))
+        json.dump(info_json, f)
+
+    # Lists of words are just the token arrays
+    print('  len(words_tr):\t', len(tokens_tr))
+    print('  len(words_ts):\t', len(tokens_ts))
+    print('  len(words_ts_h1):\t', len(tokens_ts_h1))
+    print('  len(words_ts_h2):\t', len(tokens_ts_h2))
+    print('  len(words_va):\t', len(tokens_va))
+
+    # Documents with at least one token, i.e. unique values of doc_indices
+    print('  len(np.unique(doc_indices_tr)): {} [this should be {}]'.format(np.count_nonzero(lengths_tr), len(lengths_tr)))
+    print('  len(np.unique(doc_indices_ts)): {} [this should be {}]'.format(np.count_nonzero(lengths_ts), len(lengths_ts)))
+    print('  len(np.unique(doc_indices_ts_h1)): {} [this should be {}]'.format(np.count_nonzero(lengths_ts_h1), len(lengths_ts_h1)))
+    print('  len(np.unique(doc_indices_ts_h2)): {} [this should be {}]'.format(np.count_nonzero(lengths_ts_h2), len(lengths_ts_h2)))
+    print('  len(np.unique(doc_indices_va)): {} [this should be {}]'.format(np.count_nonzero(lengths_va), len(lengths_va)))
 
     # Write raw texts of train/test/val set
-    with open(path_save + 'text_tr.txt', 'w') as f:
-        for doc in docs_tr:
-            f.write(' '.join([id2word[idx] for idx in doc]) + '\n')
-
-    with open(path_save + 'text_ts.txt', 'w') as f:
-        for doc in docs_ts:
-            f.write(' '.join([id2word[idx] for idx in doc]) + '\n')
-
-    with open(path_save + 'text_va.txt', 'w') as f:
-        for doc in docs_va:
-            f.write(' '.join([id2word[idx] for idx in doc]) + '\n')
+    def write_texts(file, words, lengths):
+        # The ids are mapped to words at once by the caller: write each document as a slice of the result
+        ends = np.cumsum(lengths)
+        with open(file, 'w') as f:
+            for start, end in zip(ends - lengths, ends):
+                f.write(' '.join(words[start:end]) + '\n')
 
-    # Number of documents in each set
-    n_docs_tr = len(docs_tr)
-    n_docs_ts = len(docs_ts)
-    n_docs_ts_h1 = len(docs_ts_h1)
-    n_docs_ts_h2 = len(docs_ts_h2)
-    n_docs_va = len(docs_va)
+    write_texts(path_save + 'text_tr.txt', id2word_arr[tokens_tr], lengths_tr)
+    write_texts(path_save + 'text_ts.txt', id2word_arr[tokens_ts], lengths_ts)
+    write_texts(path_save + 'text_va.txt', id2word_arr[tokens_va], lengths_va)
 
     # Remove unused variables
     del docs_tr
-    del docs_ts
-    del docs_ts_h1
-    del docs_ts_h2
-    del docs_va
+    del id2word_arr
 
     # Create bow representation
     print('creating bow representation...')
 
-    def create_bow(doc_indices, words, n_docs, vocab_size):
-        return sparse.coo_matrix(([1]*len(doc_indices),(doc_indices, words)), shape=(n_docs, vocab_size)).tocsr()
+    def create_bow(tokens, lengths, vocab_size):
+        # The tokens are already grouped by document: build the CSR matrix directly and sum repeated words
+        indptr = np.concatenate(([0], np.cumsum(lengths)))
+        bow = sparse.csr_matrix((np.ones(len(tokens), dtype=np.int64), tokens, indptr), shape=(len(lengths), vocab_size))
+        bow.sum_duplicates()
+        return bow
 
-    bow_tr = create_bow(doc_indices_tr, words_tr, n_docs_tr, len(vocab))
-    bow_ts = create_bow(doc_indices_ts, words_ts, n_docs_ts, len(vocab))
-    bow_ts_h1 = create_bow(doc_indices_ts_h1, words_ts_h1, n_docs_ts_h1, len(vocab))
-    bow_ts_h2 = create_bow(doc_indices_ts_h2, words_ts_h2, n_docs_ts_h2, len(vocab))
-    bow_va = create_bow(doc_indices_va, words_va, n_docs_va, len(vocab))
+    bow_tr = create_bow(tokens_tr, lengths_tr, len(vocab))
+    bow_ts = create_bow(tokens_ts, lengths_ts, len(vocab))
+    bow_ts_h1 = create_bow(tokens_ts_h1, lengths_ts_h1, len(vocab))
+    bow_ts_h2 = create_bow(tokens_ts_h2, lengths_ts_h2, len(vocab))
+    bow_va = create_bow(tokens_va, lengths_va, len(vocab))
 
     # Write the vocabulary
     # with open(path_save + 'vocab.txt', 'w') as f:
@@ -257,64 +256,31 @@ def preprocessing(data_path, docs, timestamps=[], stopwords=[], min_df=1, max_df
     #     pickle.dump(time_list, f)
 
     # Remove unused variables
-    del words_tr
-    del words_ts
-    del words_ts_h1
-    del words_ts_h2
-    del words_va
-    del doc_indices_tr
-    del doc_indices_ts
-    del doc_indices_ts_h1
-    del doc_indices_ts_h2
-    del doc_indices_va
-
-    # Save timestamps alone
-    savemat(path_save + 'bow_tr_timestamps.mat', {'timestamps': timestamps_tr}, do_compression=True)
-    savemat(path_save + 'bow_ts_timestamps.mat', {'timestamps': timestamps_ts}, do_compression=True)
-    savemat(path_save + 'bow_va_timestamps.mat', {'timestamps': timestamps_va}, do_compression=True)
-
-    # Split bow intro token/value pairs
-    print('splitting bow intro token/value pairs and saving to disk...')
-
-    def split_bow(bow_in, n_docs):
-        indices = [[w for w in bow_in[doc,:].indices] for doc in range(n_docs)]
-        counts = [[c for c in bow_in[doc,:].data] for doc in range(n_docs)]
-        return indices, counts
-
-    bow_tr_tokens, bow_tr_counts = split_bow(bow_tr, n_docs_tr)
-    savemat(path_save + 'bow_tr_tokens.mat', {'tokens': bow_tr_tokens}, do_compression=True)
-    savemat(path_save + 'bow_tr_counts.mat', {'counts': bow_tr_counts}, do_compression=True)
+    del tokens_tr
+    del tokens_ts
+    del tokens_ts_h1
+    del tokens_ts_h2
+    del tokens_va
+
+    # Save each split as the components of its CSR matrix, together with the timestamps of its documents
+    print('saving bow representation to disk...')
+
+    def save_bow(file, bow, timestamps=None):
+        arrays = {'indptr': bow.indptr, 'indices': bow.indices, 'data': bow.data}
+        if timestamps is not None:
+            arrays['timestamps'] = np.asarray(timestamps, dtype=np.int32)
+        np.savez_compressed(file, **arrays)
+
+    save_bow(path_save + 'bow_tr.npz', bow_tr, timestamps_tr)
+    save_bow(path_save + 'bow_ts.npz', bow_ts, timestamps_ts)
+    save_bow(path_save + 'bow_ts_h1.npz', bow_ts_h1)
+    save_bow(path_save + 'bow_ts_h2.npz', bow_ts_h2)
+    save_bow(path_save + 'bow_va.npz', bow_va, timestamps_va)
     del bow_tr
-    del bow_tr_tokens
-    del bow_tr_counts
-
-    bow_ts_tokens, bow_ts_counts = split_bow(bow_ts, n_docs_ts)
-    savemat(path_save + 'bow_ts_tokens.mat', {'tokens': bow_ts_tokens}, do_compression=True)
-    savemat(path_save + 'bow_ts_counts.mat', {'counts': bow_ts_counts}, do_compression=True)
     del bow_ts
-    del bow_ts_tokens
-    del bow_ts_counts
-
-    bow_ts_h1_tokens, bow_ts_h1_counts = split_bow(bow_ts_h1, n_docs_ts_h1)
-    savemat(path_save + 'bow_ts_h1_tokens.mat', {'tokens': bow_ts_h1_tokens}, do_compression=True)
-    savemat(path_save + 'bow_ts_h1_counts.mat', {'counts': bow_ts_h1_counts}, do_compression=True)
     del bow_ts_h1
-    del bow_ts_h1_tokens
-    del bow_ts_h1_counts
-
-    bow_ts_h2_tokens, bow_ts_h2_counts = split_bow(bow_ts_h2, n_docs_ts_h2)
-    savemat(path_save + 'bow_ts_h2_tokens.mat', {'tokens': bow_ts_h2_tokens}, do_compression=True)
-    savemat(path_save + 'bow_ts_h2_counts.mat', {'counts': bow_ts_h2_counts}, do_compression=True)
     del bow_ts_h2
-    del bow_ts_h2_tokens
-    del bow_ts_h2_counts
-
-    bow_va_tokens, bow_va_counts = split_bow(bow_va, n_docs_va)
-    savemat(path_save + 'bow_va_tokens.mat', {'tokens': bow_va_tokens}, do_compression=True)
-    savemat(path_save + 'bow_va_counts.mat', {'counts': bow_va_counts}, do_compression=True)
     del bow_va
-    del bow_va_tokens
-    del bow_va_counts
 
     print('Data ready!')
     print('***********')
@@ -11,12 +11,17 @@ import matplotlib
 tiny = 1e-6
 
 
+def get_top_words(beta, topk):
+    """indices of the topk largest entries of each row of beta, in decreasing order."""
+    topk = min(topk, beta.shape[1])
+    ## select the topk entries of all the rows at once, then sort only those
+    top = np.argpartition(beta, -topk, axis=1)[:, -topk:]
+    order = np.argsort(np.take_along_axis(beta, top, axis=1), axis=1)[:, ::-1]
+    return np.take_along_axis(top, order, axis=1)
+
 def get_topic_diversity(beta, topk):
     num_topics = beta.shape[0]
-    list_w = np.zeros((num_topics, topk))
-    for k in range(num_topics):
-        idx = beta[k,:].argsort()[-topk:][::-1]
-        list_w[k,:] = idx
+    list_w = get_top_words(beta, topk)
     n_unique = len(np.unique(list_w))
     TD = n_unique / (topk * num_topics)
     print('Topic diversity is: {}'.format(TD))
@@ -63,11 +68,12 @@ def get_topic_coherence(beta, data, vocab):
     print('D: ', D)
     TC = []
     num_topics = len(beta)
+    top_11 = get_top_words(beta, 11)
     for k in range(num_topics):
         if k > 0 and k % 10 == 0:
             print(k)
         print('-', end='')
-        top_10 = list(beta[k].argsort()[-11:][::-1])
+        top_10 = list(top_11[k])
         top_words = [vocab[a] for a in top_10]
         TC_k = 0
         counter = 0